@@ -1,15 +1,29 @@
 import argparse
 import asyncio
-import json
+import math
+import os
+from operator import attrgetter
 from pathlib import Path
 
+import orjson
 import telegram as tg
 from telegram.constants import ReactionEmoji
+from telegram.request import HTTPXRequest
 
-from .audiofile import get_as_ogg_opus
+from .audiofile import get_batch_as_ogg_opus
 from .config import Config
 from .state import State
 
+# Converting several files in one ffmpeg process saves on its startup costs
+_MIN_CONVERT_BATCH = 4
+_MAX_CONVERT_BATCH = 32
+
+# Daemon mode: backoff after network errors, in seconds
+_MIN_RETRY_DELAY = 1
+_MAX_RETRY_DELAY = 300
+
+_DONE_REACTIONS = frozenset({ReactionEmoji.THUMBS_UP, ReactionEmoji.OK_HAND_SIGN})
+
 
 def get_args():
     parser = argparse.ArgumentParser()
@@ -20,25 +34,27 @@ def get_args():
     )
     parser.add_argument("config_json", type=Path)
     parser.add_argument("state_dir", type=Path)
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="Keep running and long-polling for updates instead of exiting",
+    )
     args = parser.parse_args()
     return args
 
 
 def get_api_token(bot_json: Path) -> str:
-    with open(bot_json) as f:
-        data = json.load(f)
+    data = orjson.loads(bot_json.read_bytes())
     api_token = data["api_token"]
     return api_token
 
 
 def is_done_reaction(reaction_updated: tg.MessageReactionUpdated) -> bool:
-    for reaction in reaction_updated.new_reaction:
-        if isinstance(reaction, tg.ReactionTypeEmoji) and reaction.emoji in [
-            ReactionEmoji.THUMBS_UP,
-            ReactionEmoji.OK_HAND_SIGN,
-        ]:
-            return True
-    return False
+    return any(
+        isinstance(reaction, tg.ReactionTypeEmoji)
+        and reaction.emoji in _DONE_REACTIONS
+        for reaction in reaction_updated.new_reaction
+    )
 
 
 async def handle_reaction(
@@ -50,18 +66,21 @@ async def handle_reaction(
             f"Info: Ignoring reaction {reaction.new_reaction} for message {message_id}"
         )
         return True
-    source_filename = state.message_id_to_filename[str(message_id)]
+    if message_id not in state.message_id_to_filename:
+        print(f"Info: Ignoring a reaction to message {message_id}, not a voice note")
+        return True
+    source_filename = state.message_id_to_filename[message_id]
     if source_filename is None:
         print(f"Info: Ignoring a repeated Done reaction for message {message_id}")
         return True
     file = config.recordings_dir / source_filename
-    if file.is_file():
+    try:
         file.unlink()
-    else:
+    except FileNotFoundError:
         print(f"Info: Note source {source_filename} already deleted")
     ok = await reaction.chat.set_message_reaction(message_id, ReactionEmoji.HANDSHAKE)
     assert ok
-    state.message_id_to_filename[str(message_id)] = None
+    state.message_id_to_filename[message_id] = None
     return True
 
 
@@ -81,32 +100,41 @@ async def handle_update(update: tg.Update, config: Config, state: State) -> bool
     return False
 
 
-async def process_updates(bot: tg.Bot, config: Config, state: State):
+async def process_updates(
+    bot: tg.Bot, config: Config, state: State, timeout: int = 0
+) -> bool:
+    """Return False if some updates were left unprocessed."""
     last_update_id = state.last_update_id
     updates = await bot.get_updates(
         offset=last_update_id + 1,
+        timeout=timeout,
         allowed_updates=[tg.Update.MESSAGE, tg.Update.MESSAGE_REACTION],
     )
     if not updates:
         print("No updates")
-        return
+        return True
     print(f"Processing updates: {len(updates)}")
     for i, update in enumerate(updates):
         if await handle_update(update, config, state):
             state.last_update_id = update.update_id
         else:
             print(f"Updates left unprocessed: {len(updates) - i}")
-            return
+            return False
+    return True
 
 
-async def send_voice_note(bot: tg.Bot, chat_id: int, audio_file: Path, semaphore) -> tg.Message:
-    assert audio_file.is_file()
-    with get_as_ogg_opus(audio_file) as ogg_file:
-        await semaphore.acquire()
-        try:
-            return await bot.send_voice(chat_id, ogg_file, caption=audio_file.stem)
-        finally:
-            semaphore.release()
+async def send_voice_note(
+    bot: tg.Bot, chat_id: int, audio_file: Path, ogg_data: bytes, state: State
+):
+    message = await bot.send_voice(
+        chat_id,
+        ogg_data,
+        caption=audio_file.stem,
+        filename=audio_file.stem + ".ogg",
+    )
+    # Saving right away, so that a crash later on doesn't cause a resend
+    state.message_id_to_filename[message.id] = audio_file.name
+    state.save()
 
 
 async def process_voice_notes(
@@ -114,35 +142,87 @@ async def process_voice_notes(
 ):
     old_files = set(state.message_id_to_filename.values())
     old_files.discard(None)
-    new_files = [
-        file for file in recordings_dir.glob("*.m4a")
-        if file.name not in old_files
-    ]
-    if not new_files:
+    with os.scandir(recordings_dir) as it:
+        entries = [
+            entry
+            for entry in it
+            if entry.name.endswith(".m4a")
+            and entry.name not in old_files
+            and entry.is_file()
+        ]
+    if not entries:
         print("No new notes")
         return
-    new_files = sorted(new_files, key=lambda file: file.name)
+    entries.sort(key=attrgetter("name"))
+    new_files = [Path(entry.path) for entry in entries]
     print(f"Sending notes: {len(new_files)}")
-    # Sending asynchronously: send one at a time, convert the rest while sending,
-    # delete converted as soon as it's been sent.
-    # Potentially all converted notes will be stored simultaneously.
-    semaphore = asyncio.BoundedSemaphore()
-    tasks = []
+    # Converting in parallel (up to one ffmpeg process per CPU core, each converting
+    # a batch of files) while sending, one at a time and in order. Converted notes
+    # are dropped as soon as they've been sent.
+    # Potentially all converted notes will be kept in memory simultaneously.
+    cpu_count = os.cpu_count() or 1
+    batch_size = math.ceil(len(new_files) / cpu_count)
+    batch_size = min(max(batch_size, _MIN_CONVERT_BATCH), _MAX_CONVERT_BATCH)
+    batches = [
+        new_files[i : i + batch_size] for i in range(0, len(new_files), batch_size)
+    ]
+    convert_semaphore = asyncio.BoundedSemaphore(min(cpu_count, len(batches)))
     async with asyncio.TaskGroup() as taskGroup:
-        for file in new_files:
-            tasks.append(taskGroup.create_task(send_voice_note(bot, chat_id, file, semaphore)))
-    for task, file in zip(tasks, new_files):
-        message = await task
-        state.message_id_to_filename[message.id] = file.name
+        conversions = [
+            taskGroup.create_task(get_batch_as_ogg_opus(batch, convert_semaphore))
+            for batch in batches
+        ]
+        for batch, conversion in zip(batches, conversions):
+            for audio_file, ogg_data in zip(batch, await conversion):
+                if ogg_data is None:
+                    print(f"Info: Skipping {audio_file.name}, will retry next time")
+                    continue
+                await send_voice_note(bot, chat_id, audio_file, ogg_data, state)
+
+
+async def run_once(bot: tg.Bot, config: Config, state: State, timeout: int = 0) -> bool:
+    """Return False if some updates were left unprocessed."""
+    updates_done = await process_updates(bot, config, state, timeout)
+    if config.chat_id is not None:
+        await process_voice_notes(bot, config.chat_id, config.recordings_dir, state)
+    return updates_done
 
 
-async def run_bot(token: str, config: Config, state: State):
-    bot = tg.Bot(token)
+async def run_bot(token: str, config: Config, state: State, daemon: bool):
+    # Notes are uploaded one at a time, to keep them in order, so a single
+    # connection kept alive across the uploads is enough. Uploads use
+    # media_write_timeout rather than write_timeout. get_updates needs its own
+    # connection, as it may be long polling meanwhile.
+    request = HTTPXRequest(read_timeout=60, media_write_timeout=60, http_version="2")
+    get_updates_request = HTTPXRequest(http_version="2")
+    bot = tg.Bot(token, request=request, get_updates_request=get_updates_request)
     async with bot:
-        await process_updates(bot, config, state)
-        if config.chat_id is None:
+        if not daemon:
+            await run_once(bot, config, state)
             return
-        await process_voice_notes(bot, config.chat_id, config.recordings_dir, state)
+        retry_delay = _MIN_RETRY_DELAY
+        while True:
+            # Long polling: returns as soon as there are updates
+            try:
+                updates_done = await run_once(bot, config, state, config.poll_interval)
+            except* tg.error.RetryAfter as group:
+                retry_after = group.exceptions[0].retry_after
+                print(f"Info: Flood control, retrying in {retry_after} s")
+                await asyncio.sleep(retry_after)
+            except* tg.error.NetworkError as group:
+                # E.g. no connection; a failure in sending may come wrapped by
+                # the TaskGroup
+                print(f"Error: {group.exceptions[0]!r}")
+                print(f"Retrying in {retry_delay} s")
+                await asyncio.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, _MAX_RETRY_DELAY)
+            else:
+                retry_delay = _MIN_RETRY_DELAY
+                if not updates_done:
+                    # The same updates would be returned right away, not waiting
+                    print(f"Retrying the updates in {config.poll_interval} s")
+                    await asyncio.sleep(config.poll_interval)
+            state.save()
 
 
 def main():
@@ -150,7 +230,10 @@ def main():
     token = get_api_token(args.secrets_json)
     config = Config.load(args.config_json)
     state = State.load(args.state_dir)
-    asyncio.run(run_bot(token, config, state))
+    try:
+        asyncio.run(run_bot(token, config, state, args.daemon))
+    except KeyboardInterrupt:
+        print("Interrupted")
     state.save()
 
 
@@ -1,12 +1,15 @@
-import json
 from dataclasses import dataclass
 from pathlib import Path
 
+import orjson
+
 
 @dataclass
 class Config:
     chat_id: int | None
     recordings_dir: Path
+    # Daemon mode: max seconds between checks of recordings_dir
+    poll_interval: int
 
     def __post_init__(self):
         if not self.recordings_dir.is_dir():
@@ -14,9 +17,9 @@ class Config:
 
     @classmethod
     def load(cls, config_json: Path | str):
-        with open(config_json, encoding="utf-8") as f:
-            data = json.load(f)
+        data = orjson.loads(Path(config_json).read_bytes())
         return Config(
             chat_id=data.get("chat_id"),
             recordings_dir=Path(data["recordings_dir"]),
+            poll_interval=data.get("poll_interval", 50),
         )
@@ -1,7 +1,9 @@
-import json
+import os
 from dataclasses import dataclass
 from pathlib import Path
 
+import orjson
+
 _state_filename = "state.json"
 
 
@@ -9,7 +11,7 @@ _state_filename = "state.json"
 class State:
     _state_dir: Path
     last_update_id: int
-    message_id_to_filename: dict[str, str]
+    message_id_to_filename: dict[int, str | None]
 
     @classmethod
     def load(cls, state_dir: Path | str) -> "State":
@@ -17,14 +19,18 @@ class State:
         state_dir.mkdir(exist_ok=True)
         filepath = state_dir / _state_filename
         if filepath.is_file():
-            with open(filepath, encoding="utf-8") as f:
-                data = json.load(f)
+            data = orjson.loads(filepath.read_bytes())
         else:
             data = {}
         return State(
             _state_dir=state_dir,
             last_update_id=data.get("last_update_id", 0),
-            message_id_to_filename=data.get("message_id_to_filename", {})
+            message_id_to_filename={
+                int(message_id): filename
+                for message_id, filename in data.get(
+                    "message_id_to_filename", {}
+                ).items()
+            },
         )
 
     def save(self) -> None:
@@ -32,5 +38,10 @@ class State:
             "last_update_id": self.last_update_id,
             "message_id_to_filename": self.message_id_to_filename,
         }
-        with open(self._state_dir / _state_filename, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent="\t")
+        # Writing a copy and swapping it in, so that a crash can't corrupt the state
+        filepath = self._state_dir / _state_filename
+        tmp_filepath = filepath.with_name(filepath.name + ".tmp")
+        tmp_filepath.write_bytes(
+            orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+        )
+        os.replace(tmp_filepath, filepath)